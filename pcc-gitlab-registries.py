@@ -1,12 +1,56 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import os
 import os.path
 import json
+import time
+import base64
 import getpass
 import argparse
+import itertools
+from pathlib import Path
+import asyncio
+import httpx
 import requests
-from dotenv import dotenv_values
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from dotenv import load_dotenv
+
+# orjson parses and encodes roughly twice as fast as the stdlib json;
+# fall back to the stdlib when it is not installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# ijson streams large documents without building the full object tree;
+# fall back to parsing the whole file when it is not installed
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# HTTP/2 in httpx needs the optional h2 package (httpx[http2]); fall
+# back to HTTP/1.1 when it is not installed
+try:
+    import h2
+    HTTP2 = True
+except ImportError:
+    h2 = None
+    HTTP2 = False
+
+
+def json_loads(data):
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(data):
+    if orjson:
+        return orjson.dumps(data).decode()
+    return json.dumps(data)
 
 
 __author__ = 'Victor Knell'
@@ -54,6 +98,42 @@ parser.add_argument('-v', '--version', action='version')
 args = parser.parse_args()
 
 
+# number of repositories sent to the Console per batch
+BATCH_SIZE = 50
+
+# static part of the settings/registry payload, the variable fields are
+# filled in per call by set_registry
+REGISTRY_TEMPLATE = {
+    "version": "2",
+    "registry": None,
+    "repository": None,
+    "tag": "",
+    "os": "linux",
+    "cap": 5,
+    "hostname": "",
+    "scanners": 2,
+    "collections": None
+}
+
+# where the JWT is cached between runs so repeated invocations skip the login round-trip
+TOKEN_CACHE = os.path.expanduser('~/.cache/pcc-gitlab/token.json')
+
+# API prefix of the Console, set once in __main__ so the hot path only concatenates
+BASE_URL = None
+
+# transient Console errors worth retrying in-process instead of re-running the script
+RETRY_STATUSES = (502, 503, 504)
+
+# shared session so every call to the Console reuses the same TLS connection
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=32,
+                                      pool_maxsize=32,
+                                      max_retries=Retry(total=5,
+                                                        backoff_factor=0.5,
+                                                        status_forcelist=RETRY_STATUSES,
+                                                        allowed_methods=frozenset(['GET', 'POST', 'PUT', 'DELETE']))))
+
+
 # get a key securely in the terminal
 def get_key(string):
     if sys.stdin.isatty():
@@ -63,50 +143,34 @@ def get_key(string):
     return secret
 
 
-def check_env():
-    if os.path.isfile('.env'):
-        return True
-    return False
-
-
 def get_env_variables():
-    # check if an .env file exists
-    if check_env():
-        credentials = dotenv_values(".env")
-        if "COMPUTE_API_ENDPOINT" in credentials:
-            url = credentials['COMPUTE_API_ENDPOINT']
-        else:
-            url = input("Enter the compute path to the Console (Compute>System>Utilities): ")
-        if "ACCESS_KEY" in credentials:
-            access_key = credentials['ACCESS_KEY']
-        else:
-            access_key = get_key("Enter your Access Key: ")
-        if "SECRET_KEY" in credentials:
-            secret_key = credentials['SECRET_KEY']
-        else:
-            secret_key = get_key("Enter your Secret Key: ")
-    else:
-        # prompt for the access & secret keys
-        url = input("Enter the compute path to the Console (Compute>System>Utilities): ")
-        access_key = get_key("Enter your Access Key: ")
-        secret_key = get_key("Enter your Secret Key: ")
+    # merge the .env file (a no-op if absent) into the environment so
+    # secrets injected by CI work the same way, prompt for what is missing
+    load_dotenv('.env', override=False)
+    url = os.environ.get('COMPUTE_API_ENDPOINT') \
+        or input("Enter the compute path to the Console (Compute>System>Utilities): ")
+    access_key = os.environ.get('ACCESS_KEY') or get_key("Enter your Access Key: ")
+    secret_key = os.environ.get('SECRET_KEY') or get_key("Enter your Secret Key: ")
     return url, access_key, secret_key
 
 
 def check_path():
-    if not (os.path.isfile(args.json) and args.json.startswith("/")):
-        args.json = os.getcwd() + '/' + args.json
-    if not os.path.isfile(args.json):
+    # resolve relative paths against the working directory and stat once
+    p = Path(args.json).expanduser()
+    if not p.is_absolute():
+        p = Path.cwd() / p
+    if not p.is_file():
         print('The path specified for the json file does not exist')
         sys.exit()
+    args.json = str(p)
 
 
-def auth_get_token(url, user, password):
+def auth_get_token(user, password):
     """
     Method to get the JWT after login using the Access Key and the Secret Key
     Returns token
     """
-    r_url = "https://{}/api/v1/authenticate".format(url)
+    r_url = BASE_URL + "authenticate"
     r_headers = {
         'content-Type': 'application/json; charset=UTF-8',
     }
@@ -114,131 +178,220 @@ def auth_get_token(url, user, password):
         'username': '{}'.format(user),
         'password': '{}'.format(password),
     }
-    r = requests.post(r_url, headers=r_headers, data=json.dumps(r_data))
+    r = SESSION.post(r_url, headers=r_headers, data=json_dumps(r_data))
     token = r.json().get('token')
     return token
 
 
-def api_get(url, endpoint, token, data=""):
+def jwt_expiry(token):
+    """
+    Decode the exp claim of the JWT payload without verifying the signature
+    Returns the expiry as a unix timestamp, 0 if it cannot be decoded
+    """
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        claims = json_loads(base64.urlsafe_b64decode(payload))
+        return claims.get('exp', 0)
+    except (AttributeError, TypeError, IndexError, ValueError):
+        return 0
+
+
+def load_cached_token(url):
+    """
+    Read the cached JWT for this Console
+    Returns the token if it is still valid for at least a minute, None otherwise
+    """
+    try:
+        with open(TOKEN_CACHE, 'rb') as f:
+            cache = json_loads(f.read())
+    except (OSError, ValueError):
+        return None
+    if cache.get('url') != url:
+        return None
+    token = cache.get('token')
+    if token and jwt_expiry(token) - time.time() > 60:
+        return token
+    return None
+
+
+def save_cached_token(url, token):
+    """
+    Cache the JWT to disk, readable only by the current user
+    """
+    os.makedirs(os.path.dirname(TOKEN_CACHE), mode=0o700, exist_ok=True)
+    fd = os.open(TOKEN_CACHE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(json_dumps({'url': url, 'token': token, 'exp': jwt_expiry(token)}))
+
+
+def api_get(endpoint, data=None):
     """
     Method to query the Prisma Cloud CSPM API using the GET method
     Returns requests object
     """
-    r_url = "https://{}/api/v1/{}".format(url, endpoint)
-    r_headers = {
-        'content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
-        'Authorization': 'Bearer {}'.format(token),
-    }
-    r = requests.get(r_url, headers=r_headers, data=json.dumps(data))
+    r_url = BASE_URL + endpoint
+    if data is None:
+        r = SESSION.get(r_url)
+    else:
+        r = SESSION.get(r_url, data=json_dumps(data))
     return r
 
 
-def api_post(url, endpoint, token, data=""):
+def api_post(endpoint, data=""):
     """
     Method to query the Prisma Cloud CSPM API using the POST method
     Returns requests object
     """
-    r_url = "https://{}/api/v1/{}".format(url, endpoint)
-    r_headers = {
-        'content-Type': 'application/json; charset=UTF-8',
-        'Authorization': 'Bearer {}'.format(token),
-    }
-    r = requests.post(r_url, headers=r_headers, data=json.dumps(data))
+    r_url = BASE_URL + endpoint
+    r = SESSION.post(r_url, data=json_dumps(data))
     return r
 
 
-def api_put(url, endpoint, token, data=""):
+def api_put(endpoint, data=""):
     """
     Method to query the Prisma Cloud CSPM API using the PUT method
     Returns requests object
     """
-    r_url = "https://{}/api/v1/{}".format(url, endpoint)
-    r_headers = {
-        'content-Type': 'application/json; charset=UTF-8',
-        'Authorization': 'Bearer {}'.format(token),
-    }
-    r = requests.put(r_url, headers=r_headers, data=json.dumps(data))
+    r_url = BASE_URL + endpoint
+    r = SESSION.put(r_url, data=json_dumps(data))
     return r
 
 
-def api_delete(url, endpoint, token, data=""):
+def api_delete(endpoint, data=None):
     """
     Method to query the Prisma Cloud CSPM API using the DELETE method
     Returns requests object
     """
-    r_url = "https://{}/api/v1/{}".format(url, endpoint)
-    r_headers = {
-        'content-Type': 'application/json; charset=UTF-8',
-        'Authorization': 'Bearer {}'.format(token),
-    }
-    r = requests.delete(r_url, headers=r_headers, data=json.dumps(data))
+    r_url = BASE_URL + endpoint
+    if data is None:
+        r = SESSION.delete(r_url)
+    else:
+        r = SESSION.delete(r_url, data=json_dumps(data))
     return r
 
 
-def get_credentials(url, token):
+def get_credentials():
     """
     Get the credentials list
     Returns requests object
     """
     r_endpoint = "credentials"
-    r = api_get(url, r_endpoint, token)
+    r = api_get(r_endpoint)
     return r
 
 
-def get_collections(url, token):
+def get_collections():
     """
     Get the collections list
     Returns requests object
     """
     r_endpoint = "collections"
-    r = api_get(url, r_endpoint, token)
+    r = api_get(r_endpoint)
     return r
 
 
-def set_registry(url, token, registry, repository, credentials, collection):
-    r_endpoint = "settings/registry"
-    r_data = {
-        "version": "2",
-        "registry": registry,
-        "repository": repository,
-        "tag": "",
-        "os": "linux",
-        "cap": 5,
-        "hostname": "",
-        "scanners": 2,
-        "collections": [collection]
+async def get_credentials_and_collections(token):
+    """
+    Fetch the credentials and collections lists concurrently, the two
+    GETs are independent so the wall clock is the slower of the two
+    Returns both responses
+    """
+    r_headers = {
+        'content-Type': 'application/json; charset=UTF-8',
+        'Authorization': 'Bearer {}'.format(token),
     }
-    r = api_post(url, r_endpoint, token, r_data)
-    return r
+    async with httpx.AsyncClient(http2=HTTP2, base_url=BASE_URL, headers=r_headers) as client:
+        return await asyncio.gather(client.get("credentials"),
+                                    client.get("collections"))
 
 
-def list_basic_credentials(url, token):
-    r = get_credentials(url, token)
-    for i in r.json():
+def make_registry_payload(registry, collection):
+    """
+    Pre-encode the settings/registry payload around the repository field
+    Returns a function mapping a repository path to the request body bytes
+    """
+    r_data = REGISTRY_TEMPLATE.copy()
+    r_data['registry'] = registry
+    r_data['repository'] = '__REPOSITORY__'
+    r_data['collections'] = [collection]
+    prefix, suffix = json_dumps(r_data).encode().split(b'"__REPOSITORY__"')
+
+    def payload(repository):
+        return prefix + json_dumps(repository).encode() + suffix
+
+    return payload
+
+
+async def set_registry(client, semaphore, payload, repository):
+    """
+    Add one registry repository using the shared httpx client
+    Retries transient errors with exponential backoff so one 502 does
+    not abort the whole run
+    Returns the response status
+    """
+    async with semaphore:
+        for attempt in range(5):
+            try:
+                r = await client.post("settings/registry", content=payload(repository))
+                if r.status_code not in RETRY_STATUSES or attempt == 4:
+                    return r.status_code
+            except httpx.TransportError:
+                if attempt == 4:
+                    raise
+            await asyncio.sleep(0.5 * 2 ** attempt)
+
+
+def list_basic_credentials(r):
+    for i in json_loads(r.content):
         if not i.get('external'):
             print('{}'.format(i['_id']))
 
 
-def list_collections(url, token):
-    r = get_collections(url, token)
-    for i in r.json():
+def list_collections(r):
+    for i in json_loads(r.content):
         if i.get('name'):
             print('{}'.format(i['name']))
 
 
-def read_repository_list():
-    repo_list = []
-    with open(args.json, 'r') as f:
-        repositories = json.load(f)
-        for i in repositories:
-            if i.get('path'):
-                repo_list.append(i['path'])
-    return repo_list
-
-
-def add_repositories(url, token, registry, credentials, collection):
-    for i in read_repository_list():
-        set_registry(url, token, registry, i, credentials, collection)
+def iter_repository_paths():
+    # only the path of each repository is needed, so stream just those
+    # fields instead of keeping the whole parsed document in memory;
+    # merged project exports can repeat paths, so skip duplicates while
+    # keeping the original order
+    seen = set()
+    with open(args.json, 'rb') as f:
+        if ijson:
+            paths = (i for i in ijson.items(f, 'item.path') if i)
+        else:
+            paths = (i['path'] for i in json_loads(f.read()) if i.get('path'))
+        for path in paths:
+            if path not in seen:
+                seen.add(path)
+                yield path
+
+
+async def add_repositories(token, registry, credentials, collection):
+    # the POSTs are independent network waits, so fire them concurrently;
+    # HTTP/2 multiplexes the in-flight requests over a single TLS
+    # connection instead of opening one socket each, and the Console has
+    # no bulk registry endpoint, so repositories are dispatched in
+    # batches of 50 against settings/registry
+    r_headers = {
+        'content-Type': 'application/json; charset=UTF-8',
+        'Authorization': 'Bearer {}'.format(token),
+    }
+    limits = httpx.Limits(max_connections=8, max_keepalive_connections=8)
+    semaphore = asyncio.Semaphore(16)
+    payload = make_registry_payload(registry, collection)
+    repositories = iter_repository_paths()
+    async with httpx.AsyncClient(http2=HTTP2, base_url=BASE_URL, headers=r_headers, limits=limits) as client:
+        while True:
+            batch = list(itertools.islice(repositories, BATCH_SIZE))
+            if not batch:
+                break
+            await asyncio.gather(*[set_registry(client, semaphore, payload, i)
+                                   for i in batch])
 
 
 if __name__ == "__main__":
@@ -249,15 +402,27 @@ if __name__ == "__main__":
     collection = args.scope
     # get Console path, Access Key, Secret Key
     url, access_key, secret_key = get_env_variables()
-    # login and get token
-    token = auth_get_token(url, access_key, secret_key)
+    BASE_URL = "https://{}/api/v1/".format(url)
+    # login and get token, reusing a cached token while it is still valid
+    token = load_cached_token(url)
+    if not token:
+        token = auth_get_token(access_key, secret_key)
+        # the Console returns no token on bad credentials, do not cache that
+        if token:
+            save_cached_token(url, token)
+    # attach the bearer token once, every later call reuses it
+    SESSION.headers.update({
+        'Content-Type': 'application/json; charset=UTF-8',
+        'Authorization': 'Bearer {}'.format(token),
+    })
     if args.list:
+        creds, colls = asyncio.run(get_credentials_and_collections(token))
         print('Credentials')
-        list_basic_credentials(url, token)
+        list_basic_credentials(creds)
         print('')
         print('Collections/Scope')
-        list_collections(url, token)
+        list_collections(colls)
         sys.exit()
-    add_repositories(url, token, registry, credentials, collection)
+    asyncio.run(add_repositories(token, registry, credentials, collection))
 
 